@@ -1,20 +1,26 @@
+import asyncio
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
+from functools import cached_property
 from io import BytesIO
 from itertools import chain
+import os
 from pathlib import Path
-import subprocess
-import tempfile
-from typing import Iterable
+from typing import AsyncIterator, Iterable, Iterator, Mapping
 import zipfile
 
+from PIL import Image as PILImage
 from PIL.Image import Image
-from pdf2image import convert_from_bytes
+import pymupdf
 import streamlit as st
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 
 CLEAN = "Clean up pages before OCR, but do not alter the final output"
 CLEAN_FINAL = "Clean up pages before OCR and inserts the page into the final output"
+ENCODE_MAX_WORKERS = 4
+ENCODE_MAX_PENDING_BYTES = 256 << 20
 
 
 @dataclass(frozen=True)
@@ -25,126 +31,189 @@ class OcrOptions:
     redo_ocr: bool
     optimize_n: int
 
-    def get_cli_parameters(self) -> list[str]:
-        flags: dict[str, bool] = {
-            "--rotate-pages": self.rotate_pages,
-            "--deskew": self.deskew,
-            "--clean": self.clean_option == CLEAN,
-            "--clean-final": self.clean_option == CLEAN_FINAL,
-            "--redo-ocr": self.redo_ocr,
-        }
-        result = [flag for flag, enabled in flags.items() if enabled]
-        result.append("--optimize")
-        result.append(str(self.optimize_n))
-        return result
+    @cached_property
+    def cli_parameters(self) -> tuple[str, ...]:
+        """
+        The `ocrmypdf` CLI parameters for these options. Computed once, as the instance is frozen.
+        """
+        flags: tuple[tuple[str, bool], ...] = (
+            ("--rotate-pages", self.rotate_pages),
+            ("--deskew", self.deskew),
+            ("--clean", self.clean_option == CLEAN),
+            ("--clean-final", self.clean_option == CLEAN_FINAL),
+            ("--redo-ocr", self.redo_ocr),
+        )
+        return (*(flag for flag, enabled in flags if enabled), "--optimize", str(self.optimize_n))
 
 
-@dataclass(frozen=True)
+@dataclass
 class OcrResult:
     file_name: str
     return_code: int
-    stdout: str
-    stderr: str
+    stderr: bytes
     output_file_content: bytes
 
 
-def ocr_single_pdf(uploaded_file: UploadedFile, options: OcrOptions) -> OcrResult:
+def available_cpu_count() -> int:
     """
-    Performs OCR on a single PDF file by calling `ocrmypdf` in a subprocess and returns the execution result regardless of success.
+    Returns the number of CPUs this process may run on, which honours CPU affinity and cpuset limits such as Docker's
+    `--cpuset-cpus`, unlike `os.cpu_count()`.
     """
-    with (tempfile.NamedTemporaryFile(suffix=".pdf") as input_file,
-          tempfile.NamedTemporaryFile(suffix=".pdf") as output_file):
-        input_file.write(uploaded_file.read())
-        input_file.flush()
-        cmd: list[str] = list(chain(
-            ["ocrmypdf"],
-            options.get_cli_parameters(),
-            [input_file.name, output_file.name],
-        ))
-        result = subprocess.run(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        output_file.seek(0)
-        return OcrResult(uploaded_file.name, result.returncode, result.stdout.decode(), result.stderr.decode(), output_file.read())
+    return len(os.sched_getaffinity(0))
 
 
-def ocr_multi_pdf(uploaded_files: Iterable[UploadedFile], options: OcrOptions) -> tuple[list[OcrResult], list[OcrResult]]:
+async def ocr_single_pdf(file_name: str, content: bytes, options: OcrOptions, jobs: int, semaphore: asyncio.Semaphore) -> OcrResult:
     """
-    Performs OCR on multiple PDF files and returns a tuple of successful and failed results.
+    Performs OCR on a single PDF file by calling `ocrmypdf` in a subprocess with `jobs` worker processes and returns the
+    execution result regardless of success.
     """
-    successful: list[OcrResult] = []
-    failed: list[OcrResult] = []
-    for uploaded_file in uploaded_files:
-        file_path = uploaded_file.name
-        with st.spinner(f"Processing {file_path}..."):
-            result = ocr_single_pdf(uploaded_file, options)
-            if result.return_code == 0:
-                successful.append(result)
-            else:
-                st.error(f"OCRmyPDF failed to process {file_path} with error code {result.return_code}")
-                st.code(f"stdout:\n{result.stdout.decode()}\nstderr:\n{result.stderr.decode()}", language="text")
-                failed.append(result)
-    return successful, failed
+    # `-` makes ocrmypdf read the input PDF from stdin and write the output PDF to stdout, so no temporary files needed
+    cmd: list[str] = list(chain(["ocrmypdf", "--jobs", str(jobs)], options.cli_parameters, ["-", "-"]))
+    async with semaphore:
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate(content)
+    return OcrResult(file_name, process.returncode, stderr, stdout)
 
 
-def create_ocr_zip_buffer(ocr_results: Iterable[OcrResult]) -> BytesIO:
+async def ocr_multi_pdf(pdf_files: Mapping[str, tuple[str, bytes]], options: OcrOptions) -> AsyncIterator[OcrResult]:
     """
-    Creates a ZIP archive buffer from an iterable of successful OCR results.
+    Performs OCR on multiple PDF files concurrently and yields successful results as soon as they complete. Failures are
+    reported in the page.
     """
-    with st.spinner("Creating ZIP archive..."):
-        buffer = BytesIO()
-        with zipfile.ZipFile(buffer, 'w') as zip_file:
-            for result in ocr_results:
-                zip_file.writestr(result.file_name, result.output_file_content)
-        buffer.seek(0)
-        return buffer
+    if not pdf_files:
+        return
+    # ocrmypdf uses every core by default, so split the cores between concurrent runs rather than oversubscribing them
+    cpu_count = available_cpu_count()
+    concurrency = min(len(pdf_files), max(1, cpu_count // 2))
+    jobs = max(1, cpu_count // concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = st.progress(0.0, text=f"Processing {len(pdf_files)} files...")
+    tasks = [ocr_single_pdf(file_name, content, options, jobs, semaphore) for file_name, content in pdf_files.values()]
+    for i, task in enumerate(asyncio.as_completed(tasks), start=1):
+        result = await task
+        progress.progress(i / len(pdf_files), text=f"Processed {result.file_name} ({i}/{len(pdf_files)})")
+        if result.return_code == 0:
+            yield result
+        else:
+            st.error(f"OCRmyPDF failed to process {result.file_name} with error code {result.return_code}")
+            st.code(result.stderr.decode(errors="replace"), language="text")
 
 
-def save_image_file(image: Image, dir_path: Path, source_file_name: str, page_number: int, image_format: str, quality: int) -> Path:
+async def create_ocr_zip_buffer(ocr_results: AsyncIterator[OcrResult]) -> bytes:
     """
-    Saves a PIL Image in the specified directory with the given format and (if JPEG) quality.
+    Creates a ZIP archive from successful OCR results, writing each one as soon as it arrives. The output content of each
+    result is released once written.
     """
-    file_path = dir_path / f"{source_file_name}.page_{page_number}.{image_format.lower()}"
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+        async for result in ocr_results:
+            zip_file.writestr(result.file_name, result.output_file_content)
+            result.output_file_content = b""
+    return buffer.getvalue()
+
+
+def encode_image(image: Image, image_format: str, quality: int) -> bytes:
+    """
+    Encodes a PIL Image in memory with the given format and (if JPEG) quality.
+    """
+    buffer = BytesIO()
     match image_format.lower():
         case 'jpeg':
-            image.save(file_path, 'JPEG', quality=quality)
+            image.save(buffer, 'JPEG', quality=quality)
         case 'png':
-            image.save(file_path, 'PNG')
+            image.save(buffer, 'PNG')
         case _:
             raise ValueError(f"Unexpected image format: {image_format}")
-    return file_path
+    return buffer.getvalue()
 
 
-def extract_images_from_multi_pdf(uploaded_files: Iterable[UploadedFile], dpi: int) -> dict[str, list[Image]]:
+def extract_images_from_multi_pdf(pdf_files: Mapping[str, tuple[str, bytes]], dpi: int) -> Iterator[tuple[str, int, pymupdf.Pixmap]]:
     """
-    Extracts pages as images from multiple PDF files using pdf2image and returns a dictionary with PDF file names as keys and lists of PIL Image objects as values.
+    Lazily renders pages of multiple PDF files using PyMuPDF and yields tuples of PDF file stem, 1-based page number and
+    rendered page.
     """
-    results = {}
-    for uploaded_file in uploaded_files:
-        filename = uploaded_file.name
+    for filename, content in pdf_files.values():
         with st.spinner(f"Processing {filename}..."):
             try:
-                results[filename] = convert_from_bytes(uploaded_file.read(), dpi=dpi)
+                document = pymupdf.open(stream=content, filetype="pdf")
             except Exception as e:
                 st.error(f"Failed to extract images from {filename}: {e}")
                 continue
-    return results
+            with document:
+                if document.needs_pass:
+                    st.error(f"Failed to extract images from {filename}: document is password-protected")
+                    continue
+                for i in range(document.page_count):
+                    # Only rendering is guarded, so that errors raised by the consumer of this generator propagate
+                    try:
+                        pixmap = document.load_page(i).get_pixmap(dpi=dpi)
+                    except Exception as e:
+                        st.error(f"Failed to extract images from {filename} at page {i + 1}: {e}")
+                        break
+                    yield Path(filename).stem, i + 1, pixmap
+                    # Release the page before rendering the next one
+                    del pixmap
 
 
-def create_images_zip_buffer(extraction: dict[str, list[Image]], image_format: str, quality: int) -> BytesIO:
+def create_images_zip_buffer(pages: Iterable[tuple[str, int, pymupdf.Pixmap]], image_format: str, quality: int) -> bytes:
     """
-    Creates a ZIP archive buffer containing extracted images from PDF files.
+    Creates a ZIP archive containing extracted images from PDF files. Pages are encoded in a thread pool while the next
+    ones are rendered, and written to the archive in order.
     """
+    # PyMuPDF is not thread-safe and holds the GIL, so pages are rendered on this thread and only encoded in the pool,
+    # where Pillow releases the GIL
+    max_workers = min(ENCODE_MAX_WORKERS, available_cpu_count())
     with st.spinner("Creating ZIP archive..."):
-        with tempfile.TemporaryDirectory() as temp_dir:
-            file_paths = []
-            for file_name, images in extraction.items():
-                for i, img in enumerate(images):
-                    file_paths.append(save_image_file(img, Path(temp_dir), Path(file_name).stem, i + 1, image_format, quality))
-            zip_buffer = BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                for file_path in file_paths:
-                    zip_file.write(file_path, file_path.name)
-            zip_buffer.seek(0)
-            return zip_buffer
+        buffer = BytesIO()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+                pending: deque[tuple[str, int, Future[bytes]]] = deque()
+                pending_bytes = 0
+                for file_stem, page_number, pixmap in pages:
+                    image = PILImage.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples_mv, "raw", "RGB", pixmap.stride)
+                    del pixmap
+                    # Pillow stores RGB images at 4 bytes per pixel. Always let at least one page through.
+                    image_bytes = image.width * image.height * 4
+                    while pending and pending_bytes + image_bytes > ENCODE_MAX_PENDING_BYTES:
+                        file_name, written_bytes, future = pending.popleft()
+                        zip_file.writestr(file_name, future.result())
+                        pending_bytes -= written_bytes
+                    file_name = f"{file_stem}.page_{page_number}.{image_format.lower()}"
+                    pending.append((file_name, image_bytes, executor.submit(encode_image, image, image_format, quality)))
+                    pending_bytes += image_bytes
+                for file_name, _, future in pending:
+                    zip_file.writestr(file_name, future.result())
+        return buffer.getvalue()
+
+
+def read_uploaded_files(uploaded_files: Iterable[UploadedFile]) -> dict[str, tuple[str, bytes]]:
+    """
+    Returns the name and content of each uploaded file keyed by file ID. Uploads whose names collide get a numbered
+    suffix, e.g. `scan (2).pdf`, so that their archive entries stay distinct. Content is read once per upload and kept in
+    the session state, so that OCR and extraction share the same bytes across reruns.
+    """
+    cache: dict[str, bytes] = st.session_state.get("pdf_bytes", {})
+    # Rebuilt on every run so that removed uploads are released. Keyed by file ID, which changes on re-upload.
+    st.session_state.pdf_bytes = {f.file_id: cache.get(f.file_id) or f.getvalue() for f in uploaded_files}
+    results: dict[str, tuple[str, bytes]] = {}
+    # Compare stems, as extracted pages are named after the stem
+    taken_stems: set[str] = set()
+    for f in uploaded_files:
+        stem, suffix = Path(f.name).stem, Path(f.name).suffix
+        name, n = f.name, 1
+        while Path(name).stem in taken_stems:
+            n += 1
+            name = f"{stem} ({n}){suffix}"
+        taken_stems.add(Path(name).stem)
+        results[f.file_id] = (name, st.session_state.pdf_bytes[f.file_id])
+    return results
+
+
+def reset_result() -> None:
+    """Discards the archive built from the previous uploads."""
+    st.session_state.result = b''
 
 
 def main() -> None:
@@ -152,8 +221,10 @@ def main() -> None:
     st.set_page_config(page_title="OCRmyPDF")
     st.title("OCRmyPDF Web Portal")
     st.caption(f"Last updated: {datetime.now().strftime('%H:%M:%S.%f')[:-3]}")
-    uploaded_files = st.file_uploader("Upload PDF files", type=["pdf"], accept_multiple_files=True)
-    st.session_state.result = b''
+    # Keep the last archive across reruns, e.g. the one triggered by clicking "Download", until the uploads change
+    st.session_state.setdefault("result", b'')
+    uploaded_files = st.file_uploader("Upload PDF files", type=["pdf"], accept_multiple_files=True, on_change=reset_result)
+    pdf_files = read_uploaded_files(uploaded_files)
     with st.form(key="ocr"):
         rotate_pages = st.checkbox("Fix a mixture of landscape and portrait pages")
         deskew = st.checkbox("Rotate pages so that text is horizontal")
@@ -162,7 +233,7 @@ def main() -> None:
         optimize_n = st.slider("Reduce output PDF file size. 0 for lossless optimization; 3 for most aggressive optimization", min_value=0, max_value=3, value=1)
         if st.form_submit_button("OCR"):
             options = OcrOptions(rotate_pages, deskew, clean_option, redo_ocr, optimize_n)
-            st.session_state.result = create_ocr_zip_buffer(ocr_multi_pdf(uploaded_files, options)[0])
+            st.session_state.result = asyncio.run(create_ocr_zip_buffer(ocr_multi_pdf(pdf_files, options)))
     with st.form("extract"):
         col1, col2, col3 = st.columns(3)
         with col1:
@@ -172,7 +243,7 @@ def main() -> None:
         with col3:
             quality = st.number_input("JPEG Quality", min_value=1, max_value=100, value=95)
         if st.form_submit_button("Extract"):
-            st.session_state.result = create_images_zip_buffer(extract_images_from_multi_pdf(uploaded_files, dpi), image_format, quality)
+            st.session_state.result = create_images_zip_buffer(extract_images_from_multi_pdf(pdf_files, dpi), image_format, quality)
     st.download_button(
         label="Download",
         disabled=not st.session_state.result,